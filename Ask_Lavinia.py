@@ -1,9 +1,10 @@
 import toml
 import streamlit as st
 from llama_index import ServiceContext
+from langchain.chat_models import ChatOpenAI
+from llama_index.embeddings.openai import OpenAIEmbedding
 from myutils import (
     TokenCount,
-    utils_load_index,
     utils_calculate_cost,
     utils_store_qa,
 )
@@ -15,7 +16,8 @@ from ui_components import (
     ui_build_prompt,
     ui_get_pdf_for_download,
 )
-from myutils import utils_load_index
+from index_manager import IndexManager
+from llm_cache import LLMCache, CachingLLMPredictor, CachingEmbedding
 import logging
 from logging_handler import LoggingHandler
 import openai
@@ -23,6 +25,62 @@ import openai
 # Get open ai key from shared secrets streamlit service...
 openai.api_key = st.secrets["OPENAI_API_KEY"]
 
+model_name = "gpt-3.5-turbo"
+
+
+# One counter for the app; TokenCount keeps each session thread's counts separate.
+@st.cache_resource
+def get_token_count():
+    return TokenCount(model_name, verbose=False)
+
+
+# Answers a prompt or query embedding it has already seen from llm_cache.db instead of
+# going back to OpenAI.  See [llm_cache] in app_config.toml.
+@st.cache_resource
+def get_llm_cache():
+    return LLMCache.from_config(toml.load("app_config.toml").get("llm_cache", {}))
+
+
+@st.cache_resource
+def get_llm_predictor():
+    return CachingLLMPredictor(
+        get_llm_cache(),
+        llm=ChatOpenAI(
+            temperature=0,
+            model_name=model_name,
+            callbacks=[get_token_count().usage_handler],
+        ),
+        callback_manager=get_token_count().callback_manager,
+        on_cache_hit=get_token_count().mark_cache_hit,
+    )
+
+
+# Shared by every session so the query engine is not tied to the first session that asked.
+@st.cache_resource
+def get_index_manager():
+    service_context = ServiceContext.from_defaults(
+        llm_predictor=get_llm_predictor(),
+        embed_model=CachingEmbedding(get_llm_cache(), OpenAIEmbedding()),
+        callback_manager=get_token_count().callback_manager,
+    )
+    QA_TEMPLATE = ui_build_prompt()
+
+    def build_query_engine(index):
+        return index.as_query_engine(
+            verbose=False,
+            service_context=service_context,
+            text_qa_template=QA_TEMPLATE,
+        )
+
+    # Picks up new versions written by store_indices.py without a restart.
+    # The retriever embeds queries with the index's own service context, so the index
+    # has to be loaded with this one for query embeddings to go through the cache.
+    index_manager = IndexManager(
+        "indices/vector_index", build_query_engine, service_context=service_context
+    )
+    index_manager.start()
+    return index_manager
+
 
 if "logger" not in st.session_state:
     st.session_state["logger"] = LoggingHandler(log_level=logging.DEBUG)
@@ -53,38 +111,27 @@ if question not in st.session_state["questions_asked"] and len(question) != 0:
     st.session_state["logger"].DEBUG(f"QUESTION: {question}")
     st.session_state["questions_asked"].add(question)
     with st.spinner("Let me check..."):
-        model_name = "gpt-3.5-turbo"
-        token_count = TokenCount(model_name, verbose=False)
-        service_context = ServiceContext.from_defaults(
-            callback_manager=token_count.callback_manager
-        )
         st.markdown(
             "Thank you for your patience; retrieving your answer may take a bit. I'll be back as soon as I can."
         )
-        if "query_engine" not in st.session_state:
-            index = utils_load_index("indices/vector_index")
-            # Set up for getting cost info.
-
-            st.session_state["logger"].DEBUG(f"MODEL NAME: {model_name}")
-
-            QA_TEMPLATE = ui_build_prompt()
-            st.session_state["logger"].DEBUG(f"Prompt Template: {QA_TEMPLATE.prompt}")
-            st.session_state["query_engine"] = index.as_query_engine(
-                verbose=False,
-                service_context=service_context,
-                text_qa_template=QA_TEMPLATE,
-            )
-
-        response = st.session_state["query_engine"].query(question)
+        index_manager = get_index_manager()
+        st.session_state["logger"].DEBUG(
+            f"MODEL NAME: {model_name} INDEX VERSION: {index_manager.version}"
+        )
+        token_count = get_token_count()
+        token_count.reset()
+        response = index_manager.query(question)
         st.markdown(response.response)
 
+        # LLM calls answered from the cache were not counted, so this is what was paid for.
         cost = utils_calculate_cost(
             model_name,
             token_count.prompt_token_count,
             token_count.completion_token_count,
         )
         st.session_state["logger"].DEBUG(
-            f"\nRESPONSE: {response.response},\n\nCOST: {cost}"
+            f"\nRESPONSE: {response.response},\n\nCOST: {cost} "
+            f"(LLM calls from cache: {token_count.cached_call_count})"
         )
         utils_store_qa(visible, cost, question, response.response)
 
@@ -0,0 +1,69 @@
+# Micro-benchmark of the per-question token counting overhead.
+# Compares building a TokenCount for every question (the old way) with resetting one
+# shared TokenCount, both with and without the API reporting token usage.
+# Run with: python bench_token_count.py
+import timeit
+import tiktoken
+from llama_index.callbacks import CallbackManager, TokenCountingHandler
+from llama_index.callbacks.schema import CBEventType
+from langchain.schema import LLMResult
+from myutils import TokenCount
+from ui_components import ui_build_prompt
+
+MODEL_NAME = "gpt-3.5-turbo"
+NUMBER = 200
+
+with open("docs/Evergreen-Contract.txt") as f:
+    context = f.read()[:8000]
+PROMPT = ui_build_prompt().format(
+    context_str=context, query_str="What are the sick leave policies?"
+)
+COMPLETION = context[:1500]
+USAGE = LLMResult(
+    generations=[],
+    llm_output={"token_usage": {"prompt_tokens": 2000, "completion_tokens": 350}},
+)
+PAYLOAD = {"formatted_prompt": PROMPT, "response": COMPLETION}
+
+
+def _fire_llm_event(callback_manager, usage_handler=None):
+    event_id = callback_manager.on_event_start(CBEventType.LLM, payload={})
+    if usage_handler is not None:
+        usage_handler.on_llm_end(USAGE)
+    callback_manager.on_event_end(CBEventType.LLM, payload=PAYLOAD, event_id=event_id)
+
+
+def per_question_rebuild():
+    token_counter = TokenCountingHandler(
+        tokenizer=tiktoken.encoding_for_model(MODEL_NAME).encode, verbose=False
+    )
+    _fire_llm_event(CallbackManager([token_counter]))
+    return token_counter.total_llm_token_count
+
+
+shared_token_count = TokenCount(MODEL_NAME, verbose=False)
+
+
+def shared_encoding_fallback():
+    shared_token_count.reset()
+    _fire_llm_event(shared_token_count.callback_manager)
+    return shared_token_count.total_token_count
+
+
+def shared_api_usage():
+    shared_token_count.reset()
+    _fire_llm_event(
+        shared_token_count.callback_manager, shared_token_count.usage_handler
+    )
+    return shared_token_count.total_token_count
+
+
+def main():
+    for bench in (per_question_rebuild, shared_encoding_fallback, shared_api_usage):
+        bench()  # warm up
+        seconds = timeit.timeit(bench, number=NUMBER)
+        print(f"{bench.__name__:<26} {seconds / NUMBER * 1e6:10.1f} us/question")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,425 @@
+# Replays the questions stored in askl.db's qa_table against candidate index
+# configurations and reports retrieval latency, tokens, estimated cost, and how well the
+# answers and retrieved context line up with the stored answers.
+# Questions are answered on a worker pool for throughput; retrieval latency is then timed
+# in a serial pass so the threads don't skew it.
+# The candidates and models are set under [evaluation] in app_config.toml.
+# Run with: python evaluate_indices.py
+import hashlib
+import json
+import math
+import re
+import sqlite3
+import statistics
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, List, Optional
+import toml
+from langchain.chat_models import ChatOpenAI
+from langchain.llms.base import LLM
+from llama_index import (
+    ListIndex,
+    LLMPredictor,
+    Prompt,
+    QueryBundle,
+    ServiceContext,
+    SimpleDirectoryReader,
+    TreeIndex,
+    VectorStoreIndex,
+)
+from llama_index.embeddings.base import BaseEmbedding
+from llama_index.embeddings.openai import OpenAIEmbedding
+from llama_index.query_engine import RetrieverQueryEngine
+from llm_cache import LLMCache, CachingLLMPredictor, CachingEmbedding
+from myutils import TokenCount, utils_calculate_cost, utils_load_index
+from ui_components import ui_build_prompt
+
+INDEX_TYPES = {"vector": VectorStoreIndex, "list": ListIndex, "tree": TreeIndex}
+MODEL_MODES = ("stub", "replay", "openai")
+# A citation is an "Article 11" / "Article 11.3" reference, or a numbered section heading
+# at the start of a line, which is how the contract lays out its sections ("11.3").
+CITATION_RE = re.compile(
+    r"\barticle\s+(\d+(?:\.\d+)*)|^[ \t]*(\d+(?:\.\d+)+)(?=\s|$)",
+    re.IGNORECASE | re.MULTILINE,
+)
+WORD_RE = re.compile(r"\w+")
+
+
+class StubLLM(LLM):
+    """A local stand-in for the OpenAI LLM that answers with the start of the context."""
+
+    max_words: int = 150
+
+    @property
+    def _llm_type(self) -> str:
+        return "stub"
+
+    def _call(self, prompt: str, stop: Optional[List[str]] = None, **kwargs: Any) -> str:
+        # QA_TEMPLATE wraps the context as --> {context_str} <--
+        start, end = prompt.find("-->"), prompt.find("<--")
+        context = prompt[start + 3 : end] if 0 <= start < end else prompt
+        return " ".join(context.split()[: self.max_words])
+
+
+class StubEmbedding(BaseEmbedding):
+    """A local stand-in for text-embedding-ada-002 that hashes words into a vector."""
+
+    def __init__(self, embed_dim: int = 512, **kwargs: Any) -> None:
+        super().__init__(**kwargs)
+        self._embed_dim = embed_dim
+
+    def _embed(self, text: str) -> List[float]:
+        vector = [0.0] * self._embed_dim
+        for word in WORD_RE.findall(text.lower()):
+            bucket = int(hashlib.md5(word.encode("utf-8")).hexdigest(), 16)
+            vector[bucket % self._embed_dim] += 1.0
+        norm = math.sqrt(sum(v * v for v in vector)) or 1.0
+        return [v / norm for v in vector]
+
+    def _get_query_embedding(self, query: str) -> List[float]:
+        return self._embed(query)
+
+    def _get_text_embedding(self, text: str) -> List[float]:
+        return self._embed(text)
+
+    async def _aget_query_embedding(self, query: str) -> List[float]:
+        return self._embed(query)
+
+    async def _aget_text_embedding(self, text: str) -> List[float]:
+        return self._embed(text)
+
+
+def validate_settings(settings: dict) -> None:
+    """Raise ValueError for an unknown llm or embed mode."""
+    for key in ("llm", "embed"):
+        if settings[key] not in MODEL_MODES:
+            raise ValueError(
+                f"{key} must be one of {MODEL_MODES}, not {settings[key]!r}."
+            )
+
+
+def validate_candidate(candidate: dict, settings: dict) -> None:
+    """Raise ValueError for a candidate that can't run, or whose settings would be ignored."""
+    name = candidate["name"]
+    if settings["llm"] == "replay":
+        # A recording only matches if the prompt is rendered exactly as the app rendered
+        # it: the same query embedding, the same stored index, top-k and QA template.
+        if settings["embed"] != "replay":
+            raise ValueError('llm = "replay" needs embed = "replay".')
+        if "index_dir" not in candidate:
+            raise ValueError(f'{name}: llm = "replay" needs an index_dir the app served.')
+        changed = {"chunk_size", "top_k", "prompt", "index_type"} & set(candidate)
+        if changed:
+            raise ValueError(f'{name}: llm = "replay" can\'t change {sorted(changed)}.')
+    if "index_dir" in candidate:
+        if settings["embed"] == "stub":
+            # The stored indices hold 1536 dimension OpenAI embeddings.
+            raise ValueError(
+                f'{name}: an index_dir needs embed = "openai" or "replay", not "stub".'
+            )
+        return  # The index type is checked once the index is loaded.
+    index_type = candidate.get("index_type", "vector")
+    if index_type not in INDEX_TYPES:
+        raise ValueError(
+            f"{name}: index_type must be one of {sorted(INDEX_TYPES)}, "
+            f"not {index_type!r}."
+        )
+    _retriever_kwargs(candidate, INDEX_TYPES[index_type])
+
+
+def _retriever_kwargs(candidate: dict, index_class) -> dict:
+    if issubclass(index_class, VectorStoreIndex):
+        if "top_k" in candidate:
+            return {"similarity_top_k": candidate["top_k"]}
+        return {}
+    # List and tree retrievers have no top-k, so asking for one would be ignored.
+    if "top_k" in candidate:
+        raise ValueError(
+            f'{candidate["name"]}: top_k only applies to vector indices, '
+            f"not {index_class.__name__}."
+        )
+    if issubclass(index_class, TreeIndex):
+        # Walks the tree by embedding similarity rather than asking the LLM at each level.
+        return {"retriever_mode": "select_leaf_embedding"}
+    return {}
+
+
+def get_stored_qa(db_name: str) -> list:
+    conn = sqlite3.connect(db_name)
+    try:
+        records = conn.execute("SELECT question, response FROM qa_table").fetchall()
+    except sqlite3.OperationalError:
+        records = []  # No qa table yet.
+    conn.close()
+    return records
+
+
+def _replay_cache() -> LLMCache:
+    # The completions and embeddings the app recorded in its LLM cache.
+    cache_config = dict(toml.load("app_config.toml").get("llm_cache", {}))
+    cache_config["mode"] = "replay"
+    return LLMCache.from_config(cache_config)
+
+
+def get_llm_predictor(settings: dict, candidate: dict, token_count: TokenCount):
+    """Return the predictor for settings["llm"], which is "stub", "replay" or "openai"."""
+    llm, model_name = settings["llm"], settings["model_name"]
+    if llm == "stub":
+        return LLMPredictor(llm=StubLLM(), callback_manager=token_count.callback_manager)
+    if llm == "replay":
+        # validate_candidate has checked the candidate can reproduce the recorded prompts.
+        # No on_cache_hit, so the replayed calls are still counted for the cost estimate.
+        return CachingLLMPredictor(
+            _replay_cache(),
+            # Replay never reaches OpenAI, so it doesn't need a real key.
+            llm=ChatOpenAI(temperature=0, model_name=model_name, openai_api_key="replay"),
+            callback_manager=token_count.callback_manager,
+        )
+    if llm == "openai":
+        return LLMPredictor(
+            llm=ChatOpenAI(
+                temperature=0,
+                model_name=model_name,
+                callbacks=[token_count.usage_handler],
+            ),
+            callback_manager=token_count.callback_manager,
+        )
+    raise ValueError(f"llm must be one of {MODEL_MODES}, not {llm!r}.")
+
+
+def get_embed_model(embed: str):
+    """Return the embedding model for embed, which is "stub", "replay" or "openai"."""
+    if embed == "stub":
+        return StubEmbedding()
+    if embed == "replay":
+        return CachingEmbedding(_replay_cache(), OpenAIEmbedding())
+    if embed == "openai":
+        return OpenAIEmbedding()
+    raise ValueError(f"embed must be one of {MODEL_MODES}, not {embed!r}.")
+
+
+def build_query_engine(candidate: dict, settings: dict, token_count: TokenCount):
+    service_context = ServiceContext.from_defaults(
+        llm_predictor=get_llm_predictor(settings, candidate, token_count),
+        embed_model=get_embed_model(settings["embed"]),
+        chunk_size=candidate.get("chunk_size"),
+        callback_manager=token_count.callback_manager,
+    )
+    if "index_dir" in candidate:
+        # Stored indices were embedded with OpenAI, so query them with embed = "openai"
+        # or "replay".
+        index = utils_load_index(
+            candidate["index_dir"],
+            exit_on_error=False,
+            service_context=service_context,
+        )
+    else:
+        docs = SimpleDirectoryReader(settings.get("docs", "docs")).load_data()
+        index_class = INDEX_TYPES[candidate.get("index_type", "vector")]
+        index = index_class.from_documents(docs, service_context=service_context)
+    retriever_kwargs = _retriever_kwargs(candidate, type(index))
+
+    if "prompt" in candidate:
+        qa_template = Prompt(candidate["prompt"])
+    else:
+        qa_template = ui_build_prompt()
+    return RetrieverQueryEngine.from_args(
+        index.as_retriever(**retriever_kwargs),
+        service_context=service_context,
+        text_qa_template=qa_template,
+    )
+
+
+def _words(text: str) -> set:
+    return set(WORD_RE.findall(text.lower()))
+
+
+def _citations(text: str) -> set:
+    return {article or section for article, section in CITATION_RE.findall(text)}
+
+
+def evaluate_question(query_engine, token_count, model_name, question, stored_answer):
+    """Replay one stored question and score it against the stored answer.
+
+    Runs on the worker pool, so latency is timed separately by time_retrieval.
+    """
+    token_count.reset()
+    query_bundle = QueryBundle(question)
+    nodes = query_engine.retrieve(query_bundle)
+    response = query_engine.synthesize(query_bundle, nodes)
+
+    answer = response.response or ""
+    context = "\n".join(node.node.get_text() for node in nodes)
+    stored_words, answer_words = _words(stored_answer), _words(answer)
+    cited = _citations(stored_answer)
+    return {
+        "question": question,
+        "prompt_tokens": token_count.prompt_token_count,
+        "completion_tokens": token_count.completion_token_count,
+        "cost": utils_calculate_cost(
+            model_name,
+            token_count.prompt_token_count,
+            token_count.completion_token_count,
+        ),
+        # Jaccard overlap of the words in the new and stored answers.
+        "answer_overlap": len(stored_words & answer_words)
+        / max(len(stored_words | answer_words), 1),
+        # Share of the articles and sections cited in the stored answer that were
+        # retrieved / cited again.
+        "article_recall": (
+            len(cited & _citations(context)) / len(cited) if cited else None
+        ),
+        "article_overlap": (
+            len(cited & _citations(answer)) / len(cited) if cited else None
+        ),
+    }
+
+
+def time_retrieval(query_engine, question) -> float:
+    """Time retrieval for one question.  Called serially so threads don't skew it."""
+    query_bundle = QueryBundle(question)
+    start = time.perf_counter()
+    query_engine.retrieve(query_bundle)
+    return time.perf_counter() - start
+
+
+def _mean(values):
+    values = [v for v in values if v is not None]
+    return statistics.mean(values) if values else None
+
+
+def summarize(name: str, results: list, errors: int, seconds: float) -> dict:
+    latencies = sorted(
+        r["retrieval_latency"] for r in results if r.get("retrieval_latency") is not None
+    )
+    return {
+        "candidate": name,
+        "questions": len(results),
+        "errors": errors,
+        # Questions answered per second by the worker pool.
+        "throughput": len(results) / seconds if seconds else None,
+        "retrieval_latency_p50": statistics.median(latencies) if latencies else None,
+        "retrieval_latency_p95": (
+            # Nearest rank.
+            latencies[math.ceil(0.95 * len(latencies)) - 1]
+            if latencies
+            else None
+        ),
+        "prompt_tokens_mean": _mean(r["prompt_tokens"] for r in results),
+        "cost_total": sum(r["cost"] for r in results),
+        "answer_overlap_mean": _mean(r["answer_overlap"] for r in results),
+        "article_recall_mean": _mean(r["article_recall"] for r in results),
+        "article_overlap_mean": _mean(r["article_overlap"] for r in results),
+    }
+
+
+def print_report(summaries: list) -> None:
+    columns = [
+        ("candidate", "{}"),
+        ("questions", "{}"),
+        ("errors", "{}"),
+        ("throughput", "{:.2f}"),
+        ("retrieval_latency_p50", "{:.4f}"),
+        ("retrieval_latency_p95", "{:.4f}"),
+        ("prompt_tokens_mean", "{:.0f}"),
+        ("cost_total", "{:.5f}"),
+        ("answer_overlap_mean", "{:.3f}"),
+        ("article_recall_mean", "{:.3f}"),
+        ("article_overlap_mean", "{:.3f}"),
+    ]
+    print(" | ".join(name for name, _ in columns))
+    for summary in summaries:
+        print(
+            " | ".join(
+                "-" if summary[name] is None else fmt.format(summary[name])
+                for name, fmt in columns
+            )
+        )
+
+
+def main():
+    settings = {
+        "db": "askl.db",
+        "llm": "stub",
+        "embed": "stub",
+        "model_name": "gpt-3.5-turbo",
+        "workers": 4,
+        "report": "eval_report.json",
+        "candidates": [],
+    }
+    settings.update(toml.load("app_config.toml").get("evaluation", {}))
+    # Check everything up front so a bad setting doesn't lose a finished run.
+    with open("openai_costs.json") as f:
+        priced_models = json.load(f)["openai_LLMs"]
+    if settings["model_name"] not in priced_models:
+        print(
+            f"ERROR: {settings['model_name']} is not in openai_costs.json "
+            f"({', '.join(priced_models)}). Exiting."
+        )
+        sys.exit(1)
+    try:
+        validate_settings(settings)
+        for candidate in settings["candidates"]:
+            validate_candidate(candidate, settings)
+    except ValueError as e:
+        print(f"ERROR: {e} Exiting.")
+        sys.exit(1)
+    qa_records = get_stored_qa(settings["db"])
+    print(f"Replaying {len(qa_records)} questions from {settings['db']}...")
+
+    report = {"settings": settings, "summaries": [], "results": {}}
+    with ThreadPoolExecutor(max_workers=settings["workers"]) as executor:
+        for candidate in settings["candidates"]:
+            name = candidate["name"]
+            print(f"Building {name}...")
+            # Counts are kept per thread, so one TokenCount serves all the workers.
+            token_count = TokenCount(settings["model_name"], verbose=False)
+            try:
+                query_engine = build_query_engine(candidate, settings, token_count)
+            except Exception as e:
+                # Report it and carry on, so the other candidates' results are kept.
+                print(f"ERROR: building {name}: {e}")
+                summary = summarize(name, [], len(qa_records), 0)
+                summary["build_error"] = str(e)
+                report["summaries"].append(summary)
+                continue
+            start = time.perf_counter()
+            futures = [
+                executor.submit(
+                    evaluate_question,
+                    query_engine,
+                    token_count,
+                    settings["model_name"],
+                    question,
+                    stored_answer,
+                )
+                for question, stored_answer in qa_records
+            ]
+            results, errors = [], 0
+            for future in futures:
+                try:
+                    results.append(future.result())
+                except Exception as e:
+                    print(f"ERROR: {name}: {e}")
+                    errors += 1
+            seconds = time.perf_counter() - start
+            for result in results:
+                try:
+                    result["retrieval_latency"] = time_retrieval(
+                        query_engine, result["question"]
+                    )
+                except Exception as e:
+                    print(f"ERROR: {name}: timing {result['question']!r}: {e}")
+                    result["retrieval_latency"] = None
+            report["results"][name] = results
+            report["summaries"].append(summarize(name, results, errors, seconds))
+
+    print_report(report["summaries"])
+    with open(settings["report"], "w") as f:
+        json.dump(report, f, indent=2)
+    print(f"Wrote {settings['report']}.")
+
+
+if __name__ == "__main__":
+    main()
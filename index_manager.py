@@ -0,0 +1,162 @@
+import threading
+import logging
+from logging_handler import LoggingHandler
+from myutils import (
+    utils_load_index,
+    utils_current_index_version,
+    utils_touch_index_lease,
+    utils_release_index_lease,
+)
+
+
+class _EngineSlot:
+    """A loaded index and its query engine, together with the index version."""
+
+    def __init__(self, version, index, query_engine):
+        self.version = version
+        self.index = index
+        self.query_engine = query_engine
+        self.in_flight = 0
+        self.retired = False
+
+
+class IndexManager:
+    """
+    Serves queries from the current version of an index and hot swaps to a new
+    version when store_indices.py publishes one.
+
+    A background thread polls the index's CURRENT pointer.  When it changes, the new
+    version is loaded and its query engine built off to the side, then swapped in as a
+    single assignment.  Queries already running on the old engine finish on it; the old
+    engine is dropped once the last of them returns.
+
+    While a version is loaded, a lease file tells store_indices.py not to prune it.
+
+    Attributes
+    ----------
+    name : str
+        The index directory, e.g. 'indices/vector_index'.
+    build_query_engine : callable
+        Takes a loaded index and returns the query engine to serve it with.
+    poll_interval : float
+        Seconds between checks of the CURRENT pointer.
+    service_context : ServiceContext, optional
+        Loaded indices use it for their own calls, e.g. the retriever's query embeddings.
+    """
+
+    def __init__(
+        self, name, build_query_engine, poll_interval=30.0, service_context=None
+    ):
+        self.name = name
+        self.build_query_engine = build_query_engine
+        self.poll_interval = poll_interval
+        self.service_context = service_context
+        self.logger = LoggingHandler(log_level=logging.DEBUG)
+        self._lock = threading.Lock()
+        self._slot = None
+        # Retired slots still waiting for their in-flight queries to finish.
+        self._draining = []
+        self._stop_event = threading.Event()
+        self._thread = None
+
+    @property
+    def version(self):
+        with self._lock:
+            return self._slot.version if self._slot else None
+
+    def start(self):
+        """Load the current version, then start watching for new ones."""
+        if self._slot is None:
+            self._load(utils_current_index_version(self.name))
+        if self._thread is None:
+            self._thread = threading.Thread(
+                target=self._watch, name=f"IndexManager({self.name})", daemon=True
+            )
+            self._thread.start()
+
+    def stop(self):
+        self._stop_event.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+    def check_for_update(self) -> bool:
+        """Swap in the version CURRENT points at if it is not the one being served."""
+        version = utils_current_index_version(self.name)
+        if version == self.version:
+            return False
+        self._load(version)
+        return True
+
+    def query(self, question, build_query_engine=None):
+        """Answer question with the current version of the index.
+
+        Pass build_query_engine to answer with an engine built just for this question
+        over the current index, e.g. one wired to a per-question token counter.
+        """
+        with self._lock:
+            slot = self._slot
+            slot.in_flight += 1
+        try:
+            if build_query_engine is None:
+                query_engine = slot.query_engine
+            else:
+                query_engine = build_query_engine(slot.index)
+            return query_engine.query(question)
+        finally:
+            with self._lock:
+                slot.in_flight -= 1
+                if slot.retired and slot.in_flight == 0:
+                    self._release(slot)
+
+    def _load(self, version):
+        # Take the lease before loading so the version can't be pruned from under us.
+        if version is not None:
+            utils_touch_index_lease(self.name, version)
+        # Loading and building happen outside the lock so queries keep flowing.
+        try:
+            index = utils_load_index(
+                self.name,
+                version=version,
+                exit_on_error=False,
+                service_context=self.service_context,
+            )
+            new_slot = _EngineSlot(version, index, self.build_query_engine(index))
+        except Exception:
+            if version is not None and version != self.version:
+                utils_release_index_lease(self.name, version)
+            raise
+        with self._lock:
+            old_slot = self._slot
+            self._slot = new_slot
+            if old_slot is not None:
+                old_slot.retired = True
+                if old_slot.in_flight == 0:
+                    self._release(old_slot)
+                else:
+                    self._draining.append(old_slot)
+        self.logger.INFO(f"Serving index {self.name} version {version}.")
+
+    def _release(self, slot):
+        slot.index = None
+        slot.query_engine = None
+        if slot in self._draining:
+            self._draining.remove(slot)
+        if slot.version is not None and slot.version != self._slot.version:
+            utils_release_index_lease(self.name, slot.version)
+        self.logger.INFO(f"Retired index {self.name} version {slot.version}.")
+
+    def _refresh_leases(self):
+        with self._lock:
+            versions = {slot.version for slot in [self._slot] + self._draining}
+        for version in versions - {None}:
+            utils_touch_index_lease(self.name, version)
+
+    def _watch(self):
+        while not self._stop_event.wait(self.poll_interval):
+            try:
+                self._refresh_leases()
+                self.check_for_update()
+            except Exception as e:
+                # Keep serving the old version; the next poll will try again.
+                self.logger.ERROR(f"Could not load new version of {self.name}: {e}")
@@ -0,0 +1,240 @@
+import hashlib
+import json
+import sqlite3
+import threading
+import time
+from contextlib import contextmanager
+from typing import Any, List
+from llama_index import LLMPredictor
+from llama_index.embeddings.base import BaseEmbedding
+
+CACHE_MODES = ("on", "off", "record", "replay")
+
+
+class LLMCacheMiss(Exception):
+    """Raised in replay mode when a prompt or text has no recording."""
+
+
+class LLMCache:
+    """
+    A persistent cache of LLM completions and embeddings, stored in a SQLite database.
+
+    Completions are keyed on the model, a hash of the fully rendered prompt, and the
+    sampling parameters, so the same prompt sent with a different temperature is a
+    different entry.  Embeddings are keyed on the embedding model and the text.
+
+    Attributes
+    ----------
+    path : str
+        The SQLite file the completions are stored in.
+    mode : str
+        'on' reads and writes the cache, 'off' bypasses it, 'record' is like 'on' but
+        what it writes is kept for replay, and 'replay' only reads and never lets a call
+        through to OpenAI.
+    max_entries : int
+        Once the cache holds more entries than this, the least recently used are dropped.
+    ttl : float
+        Seconds an entry stays valid.  None keeps entries until they are evicted.
+        Entries written in record mode are exempt from both the ttl and max_entries,
+        so recordings are only removed by clear().
+    """
+
+    def __init__(self, path="llm_cache.db", mode="on", max_entries=1000, ttl=None):
+        if mode not in CACHE_MODES:
+            raise ValueError(f"Cache mode must be one of {CACHE_MODES}, not {mode}.")
+        self.path = path
+        self.mode = mode
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        if self.mode != "off":
+            with self._connect() as conn:
+                conn.execute(
+                    """CREATE TABLE IF NOT EXISTS llm_cache (
+                    cache_key TEXT PRIMARY KEY,
+                    model TEXT,
+                    params TEXT,
+                    completion TEXT,
+                    created REAL,
+                    last_used REAL,
+                    pinned INTEGER NOT NULL DEFAULT 0
+                )"""
+                )
+
+    @classmethod
+    def from_config(cls, config: dict):
+        """Build the cache from the [llm_cache] table of app_config.toml."""
+        ttl_days = config.get("ttl_days")
+        return cls(
+            path=config.get("path", "llm_cache.db"),
+            mode=config.get("mode", "on"),
+            max_entries=config.get("max_entries", 1000),
+            ttl=ttl_days * 24 * 60 * 60 if ttl_days else None,
+        )
+
+    @staticmethod
+    def make_key(model: str, prompt: str, params: dict) -> str:
+        prompt_hash = hashlib.sha256(prompt.encode("utf-8")).hexdigest()
+        key_str = json.dumps([model, prompt_hash, params], sort_keys=True, default=str)
+        return hashlib.sha256(key_str.encode("utf-8")).hexdigest()
+
+    def lookup(self, model: str, prompt: str, params: dict):
+        """Return the cached completion, or None if there isn't a usable one."""
+        if self.mode == "off":
+            return None
+        key = self.make_key(model, prompt, params)
+        now = time.time()
+        with self._lock, self._connect() as conn:
+            row = conn.execute(
+                "SELECT completion, created, pinned FROM llm_cache WHERE cache_key = ?",
+                (key,),
+            ).fetchone()
+            if row is None:
+                return None
+            completion, created, pinned = row
+            expired = self.ttl is not None and now - created > self.ttl
+            if expired and not pinned and self.mode != "replay":
+                conn.execute("DELETE FROM llm_cache WHERE cache_key = ?", (key,))
+                return None
+            if self.mode != "replay":
+                conn.execute(
+                    "UPDATE llm_cache SET last_used = ? WHERE cache_key = ?", (now, key)
+                )
+        return completion
+
+    def update(self, model: str, prompt: str, params: dict, completion: str) -> None:
+        if self.mode not in ("on", "record"):
+            return
+        key = self.make_key(model, prompt, params)
+        now = time.time()
+        with self._lock, self._connect() as conn:
+            conn.execute(
+                """INSERT INTO llm_cache
+                (cache_key, model, params, completion, created, last_used, pinned)
+                VALUES (?, ?, ?, ?, ?, ?, ?)
+                ON CONFLICT(cache_key) DO UPDATE SET
+                completion = excluded.completion,
+                created = excluded.created,
+                last_used = excluded.last_used,
+                pinned = MAX(pinned, excluded.pinned)""",
+                (
+                    key,
+                    model,
+                    json.dumps(params, sort_keys=True, default=str),
+                    completion,
+                    now,
+                    now,
+                    int(self.mode == "record"),
+                ),
+            )
+            if self.ttl is not None:
+                conn.execute(
+                    "DELETE FROM llm_cache WHERE pinned = 0 AND created < ?",
+                    (now - self.ttl,),
+                )
+            conn.execute(
+                """DELETE FROM llm_cache WHERE pinned = 0 AND cache_key NOT IN (
+                SELECT cache_key FROM llm_cache WHERE pinned = 0
+                ORDER BY last_used DESC LIMIT ?
+                )""",
+                (self.max_entries,),
+            )
+
+    def lookup_embedding(self, model: str, text: str):
+        embedding = self.lookup(model, text, {"kind": "embedding"})
+        return None if embedding is None else json.loads(embedding)
+
+    def update_embedding(self, model: str, text: str, embedding: List[float]) -> None:
+        self.update(model, text, {"kind": "embedding"}, json.dumps(embedding))
+
+    def clear(self) -> None:
+        with self._lock, self._connect() as conn:
+            conn.execute("DELETE FROM llm_cache")
+
+    @contextmanager
+    def _connect(self):
+        # A connection per call keeps the cache usable from every Streamlit session thread.
+        conn = sqlite3.connect(self.path)
+        try:
+            with conn:
+                yield conn
+        finally:
+            conn.close()
+
+
+class CachingLLMPredictor(LLMPredictor):
+    """
+    An LLMPredictor that answers from an LLMCache before calling the LLM.
+
+    The callback events still fire for cached answers.  Pass on_cache_hit, e.g.
+    TokenCount.mark_cache_hit, to be told which of them were never sent to OpenAI.
+    """
+
+    def __init__(self, llm_cache: LLMCache, *args, on_cache_hit=None, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.llm_cache = llm_cache
+        self.on_cache_hit = on_cache_hit
+
+    def _llm_model_and_params(self):
+        params = dict(getattr(self._llm, "_identifying_params", {}))
+        model = params.pop("model_name", None) or params.pop("model", "unknown")
+        return model, params
+
+    def _predict(self, prompt, **prompt_args) -> str:
+        if self.llm_cache.mode == "off":
+            return super()._predict(prompt, **prompt_args)
+
+        model, params = self._llm_model_and_params()
+        formatted_prompt = prompt.format(llm=self._llm, **prompt_args)
+        completion = self.llm_cache.lookup(model, formatted_prompt, params)
+        if completion is not None:
+            if self.on_cache_hit is not None:
+                self.on_cache_hit()
+            return completion
+        if self.llm_cache.mode == "replay":
+            raise LLMCacheMiss(f"No recorded completion from {model} for this prompt.")
+
+        completion = super()._predict(prompt, **prompt_args)
+        self.llm_cache.update(model, formatted_prompt, params, completion)
+        return completion
+
+
+class CachingEmbedding(BaseEmbedding):
+    """
+    Wraps an embedding model so its embeddings are answered from an LLMCache.
+
+    Replaying a question needs the query embedding as well as the completion: without
+    it the query would still go to OpenAI, and a different embedding could retrieve
+    different context, so the rendered prompt would not match its recording.
+    """
+
+    def __init__(self, llm_cache: LLMCache, embed_model: BaseEmbedding, **kwargs: Any):
+        super().__init__(**kwargs)
+        self.llm_cache = llm_cache
+        self.embed_model = embed_model
+        model = getattr(embed_model, "model", None) or type(embed_model).__name__
+        self.model_name = str(getattr(model, "value", model))
+
+    def _cached(self, text: str, embed) -> List[float]:
+        if self.llm_cache.mode == "off":
+            return embed(text)
+        embedding = self.llm_cache.lookup_embedding(self.model_name, text)
+        if embedding is not None:
+            return embedding
+        if self.llm_cache.mode == "replay":
+            raise LLMCacheMiss(f"No recorded embedding from {self.model_name} for this text.")
+        embedding = embed(text)
+        self.llm_cache.update_embedding(self.model_name, text, embedding)
+        return embedding
+
+    def _get_query_embedding(self, query: str) -> List[float]:
+        return self._cached(query, self.embed_model._get_query_embedding)
+
+    def _get_text_embedding(self, text: str) -> List[float]:
+        return self._cached(text, self.embed_model._get_text_embedding)
+
+    async def _aget_query_embedding(self, query: str) -> List[float]:
+        return self._get_query_embedding(query)
+
+    async def _aget_text_embedding(self, text: str) -> List[float]:
+        return self._get_text_embedding(text)
@@ -7,8 +7,13 @@ from llama_index import (
     ListIndex,
     TreeIndex,
 )
-from llama_index.callbacks import CallbackManager, TokenCountingHandler
+from llama_index.callbacks import CallbackManager
+from llama_index.callbacks.base import BaseCallbackHandler
+from llama_index.callbacks.schema import CBEventType
+from langchain.callbacks.base import BaseCallbackHandler as LangchainCallbackHandler
 import tiktoken
+import threading
+from functools import lru_cache
 import faiss
 from tqdm import tqdm
 import sys
@@ -16,6 +21,9 @@ from bs4 import BeautifulSoup
 from urllib.parse import urljoin
 import requests
 import json
+import os
+import shutil
+import time
 import sqlite3
 from logging_handler import LoggingHandler
 import logging
@@ -55,23 +63,159 @@ def utils_TreeStoreIndex_documents(docs):
     return index
 
 
+# Versioned index layout:
+#   <name>/versions/<version>/...   one persisted index per build
+#   <name>/CURRENT                  holds the version the app should serve
+#   <name>/serving/<version>.<pid>  lease held by an app process serving that version
+# An index directory without a CURRENT file is the older flat layout and is loaded as is.
+INDEX_POINTER_FILE = "CURRENT"
+INDEX_VERSIONS_DIR = "versions"
+INDEX_LEASES_DIR = "serving"
+# A lease not refreshed for this many seconds belongs to an app that is no longer running.
+INDEX_LEASE_TIMEOUT = 10 * 60
+
+
 def utils_store_index(index, name: str) -> None:
     index.storage_context.persist(persist_dir=name)
 
 
+def utils_store_index_version(index, name: str, keep: int = 3) -> str:
+    """Persist the index as a new version under name, then point CURRENT at it.
+
+    The pointer is only flipped once the new version is fully written, and the
+    flip itself is an atomic rename, so a running app never sees a half written index.
+    Afterwards all but the newest keep versions are pruned.
+    """
+    version = time.strftime("%Y%m%dT%H%M%S", time.gmtime())
+    versions_dir = os.path.join(name, INDEX_VERSIONS_DIR)
+    persist_dir = os.path.join(versions_dir, version)
+    suffix = 1
+    while os.path.exists(persist_dir):
+        persist_dir = os.path.join(versions_dir, f"{version}-{suffix}")
+        suffix += 1
+    version = os.path.basename(persist_dir)
+    index.storage_context.persist(persist_dir=persist_dir)
+
+    pointer = os.path.join(name, INDEX_POINTER_FILE)
+    tmp_pointer = pointer + ".tmp"
+    with open(tmp_pointer, "w") as f:
+        f.write(version)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_pointer, pointer)
+    utils_prune_index_versions(name, keep=keep)
+    return version
+
+
+def utils_prune_index_versions(name: str, keep: int = 3) -> list:
+    """Delete old versions of the index, keeping CURRENT and the newest keep versions.
+
+    Versions an app process still holds a fresh lease on are skipped.
+    Returns the versions that were deleted.
+    """
+    versions_dir = os.path.join(name, INDEX_VERSIONS_DIR)
+    if not os.path.isdir(versions_dir):
+        return []
+    # Version names are UTC timestamps, so they sort oldest first.
+    versions = sorted(os.listdir(versions_dir))
+    protected = set(versions[-keep:]) if keep > 0 else set()
+    protected.add(utils_current_index_version(name))
+    protected |= utils_served_index_versions(name)
+    pruned = []
+    for version in versions:
+        if version in protected:
+            continue
+        shutil.rmtree(os.path.join(versions_dir, version))
+        pruned.append(version)
+    return pruned
+
+
+def _index_lease_path(name: str, version: str) -> str:
+    return os.path.join(name, INDEX_LEASES_DIR, f"{version}.{os.getpid()}")
+
+
+def utils_touch_index_lease(name: str, version: str) -> None:
+    """Mark version as being served by this process.  Call again to refresh it."""
+    lease = _index_lease_path(name, version)
+    os.makedirs(os.path.dirname(lease), exist_ok=True)
+    with open(lease, "a"):
+        os.utime(lease)
+
+
+def utils_release_index_lease(name: str, version: str) -> None:
+    try:
+        os.remove(_index_lease_path(name, version))
+    except FileNotFoundError:
+        pass
+
+
+def utils_served_index_versions(name: str) -> set:
+    """Return the versions some app process has a fresh lease on."""
+    leases_dir = os.path.join(name, INDEX_LEASES_DIR)
+    if not os.path.isdir(leases_dir):
+        return set()
+    now = time.time()
+    served = set()
+    for lease in os.listdir(leases_dir):
+        lease_path = os.path.join(leases_dir, lease)
+        try:
+            fresh = now - os.path.getmtime(lease_path) < INDEX_LEASE_TIMEOUT
+        except FileNotFoundError:
+            continue
+        if fresh:
+            served.add(lease.rsplit(".", 1)[0])
+        else:
+            # Left behind by an app that exited without releasing it.
+            try:
+                os.remove(lease_path)
+            except FileNotFoundError:
+                pass
+    return served
+
+
+def utils_current_index_version(name: str):
+    """Return the version CURRENT points at, or None for the flat layout."""
+    try:
+        with open(os.path.join(name, INDEX_POINTER_FILE)) as f:
+            version = f.read().strip()
+    except FileNotFoundError:
+        return None
+    return version or None
+
+
+def utils_current_index_dir(name: str) -> str:
+    version = utils_current_index_version(name)
+    if version is None:
+        return name
+    return os.path.join(name, INDEX_VERSIONS_DIR, version)
+
+
 # @st.cache_resource
-def utils_load_index(name: str):
+def utils_load_index(name: str, version=None, exit_on_error=True, service_context=None):
+    """Load the index stored under name.
+
+    By default the version CURRENT points at is loaded.  Pass exit_on_error=False
+    to get the exception instead of exiting, e.g. when loading in a background thread.
+    """
+    if version is None:
+        persist_dir = utils_current_index_dir(name)
+    else:
+        persist_dir = os.path.join(name, INDEX_VERSIONS_DIR, version)
     try:
         # load index from disk
-        vector_store = FaissVectorStore.from_persist_dir(name)
+        vector_store = FaissVectorStore.from_persist_dir(persist_dir)
         storage_context = StorageContext.from_defaults(
-            persist_dir=name, vector_store=vector_store
+            persist_dir=persist_dir, vector_store=vector_store
         )
         index = load_index_from_storage(
-            persist_dir=name, storage_context=storage_context
+            persist_dir=persist_dir,
+            storage_context=storage_context,
+            service_context=service_context,
         )
         return index
     except Exception as e:
+        if not exit_on_error:
+            raise
         print(f"ERROR: {e}. Exiting.")
         sys.exit(1)
 
@@ -216,16 +360,130 @@ def utils_store_qa(visible: bool, cost: float, question: str, response: str):
         s.commit()
 
 
+@lru_cache(maxsize=None)
+def utils_get_tokenizer(model_name: str):
+    """Return the tiktoken encode function for the model, built once per process."""
+    return tiktoken.encoding_for_model(model_name).encode
+
+
+class _RequestTokenCounts:
+    """The token counts for one request."""
+
+    def __init__(self):
+        self.prompt_tokens = 0
+        self.completion_tokens = 0
+        self.embedding_tokens = 0
+        self.prompt = None
+        self.completion = None
+        self.cached_calls = 0
+        # Usage reported by the API for the LLM call in progress.
+        self.pending_usage = None
+        # Set when the LLM call in progress was answered from the LLM cache.
+        self.pending_cache_hit = False
+
+
+class _UsageTokenCountingHandler(BaseCallbackHandler):
+    """
+    Counts tokens for the llama_index LLM and embedding events of the current thread.
+
+    This is not a TokenCountingHandler: its counts are per thread and are read through
+    TokenCount, not through TokenCountingHandler's attributes.
+
+    LLM calls use the token usage the OpenAI API reported for them.  Only when there is
+    none are the prompt and completion encoded.  Calls marked as answered from the LLM
+    cache were never sent to OpenAI and add no tokens.
+    """
+
+    def __init__(self, tokenizer, verbose=False):
+        super().__init__(event_starts_to_ignore=[], event_ends_to_ignore=[])
+        self._tokenizer = tokenizer
+        self._verbose = verbose
+        self._local = threading.local()
+
+    @property
+    def counts(self) -> _RequestTokenCounts:
+        if not hasattr(self._local, "counts"):
+            self._local.counts = _RequestTokenCounts()
+        return self._local.counts
+
+    def reset(self) -> None:
+        self._local.counts = _RequestTokenCounts()
+
+    def start_trace(self, trace_id=None) -> None:
+        pass
+
+    def end_trace(self, trace_id=None, trace_map=None) -> None:
+        pass
+
+    def on_event_start(self, event_type, payload=None, event_id="", **kwargs):
+        if event_type == CBEventType.LLM:
+            self.counts.pending_usage = None
+            self.counts.pending_cache_hit = False
+        return event_id
+
+    def on_event_end(self, event_type, payload=None, event_id="", **kwargs):
+        if payload is None:
+            return
+        counts = self.counts
+        if event_type == CBEventType.LLM:
+            counts.prompt = payload.get("formatted_prompt")
+            counts.completion = payload.get("response")
+            if counts.pending_cache_hit:
+                prompt_tokens = completion_tokens = 0
+                counts.cached_calls += 1
+                counts.pending_cache_hit = False
+            elif counts.pending_usage is not None:
+                prompt_tokens, completion_tokens = counts.pending_usage
+                counts.pending_usage = None
+            else:
+                prompt_tokens = len(self._tokenizer(counts.prompt or ""))
+                completion_tokens = len(self._tokenizer(counts.completion or ""))
+            counts.prompt_tokens += prompt_tokens
+            counts.completion_tokens += completion_tokens
+            if self._verbose:
+                print(
+                    f"LLM Prompt Token Usage: {prompt_tokens}\n"
+                    f"LLM Completion Token Usage: {completion_tokens}",
+                    flush=True,
+                )
+        elif event_type == CBEventType.EMBEDDING:
+            for chunk in payload.get("chunks", []):
+                counts.embedding_tokens += len(self._tokenizer(chunk))
+
+
+class _OpenAIUsageHandler(LangchainCallbackHandler):
+    """Passes the token usage from OpenAI's response on to the token counter."""
+
+    def __init__(self, token_counter: _UsageTokenCountingHandler):
+        self.token_counter = token_counter
+
+    def on_llm_end(self, response, **kwargs):
+        usage = (response.llm_output or {}).get("token_usage")
+        if usage and "prompt_tokens" in usage:
+            self.token_counter.counts.pending_usage = (
+                usage["prompt_tokens"],
+                usage.get("completion_tokens", 0),
+            )
+
+
 class TokenCount:
     """
     A class to count up the number of tokens used.
 
+    One TokenCount is built per model and reused for every question.  Counts are kept
+    per thread, so each Streamlit session counts its own question; call reset() before
+    each one.
+
     Attributes
     ----------
-    token_counter : TokenCountingHandler
-        a TokenCountingHandler object that counts tokens in the model
+    token_counter : BaseCallbackHandler
+        a llama_index callback handler that keeps this thread's token counts; read them
+        through the properties below
     callback_manager : CallbackManager
         a CallbackManager object that manages callbacks for the token counter
+    usage_handler : BaseCallbackHandler
+        a langchain callback handler to give to the LLM so the token usage reported
+        by the API is used instead of encoding the prompt and completion
 
     """
 
@@ -244,12 +502,21 @@ class TokenCount:
 
         # Set up callback
         # Note: If they generate an error, an upper level try/except will catch.
-        self.token_counter = TokenCountingHandler(
-            tokenizer=tiktoken.encoding_for_model(model_name).encode, verbose=verbose
+        self.token_counter = _UsageTokenCountingHandler(
+            tokenizer=utils_get_tokenizer(model_name), verbose=verbose
         )
+        self.usage_handler = _OpenAIUsageHandler(self.token_counter)
 
         self.callback_manager = CallbackManager([self.token_counter])
 
+    def reset(self):
+        """Start counting a new request on this thread."""
+        self.token_counter.reset()
+
+    def mark_cache_hit(self):
+        """Don't count the LLM call in progress on this thread; it was answered from the cache."""
+        self.token_counter.counts.pending_cache_hit = True
+
     @property
     def callback_manager(self):
         return self._callback_manager
@@ -260,24 +527,29 @@ class TokenCount:
 
     @property
     def embedding_token_count(self):
-        return self.token_counter.embedding_token_counts
+        return self.token_counter.counts.embedding_tokens
 
     @property
     def prompt_token_count(self):
-        return self.token_counter.prompt_llm_token_count
+        return self.token_counter.counts.prompt_tokens
 
     @property
     def completion_token_count(self):
-        return self.token_counter.completion_llm_token_count
+        return self.token_counter.counts.completion_tokens
+
+    @property
+    def cached_call_count(self):
+        """The number of LLM calls answered from the LLM cache, which add no tokens."""
+        return self.token_counter.counts.cached_calls
 
     @property
     def total_token_count(self):
-        return self.token_counter.total_llm_token_count
+        return self.prompt_token_count + self.completion_token_count
 
     @property
     def prompt(self):
-        return self.token_counter.llm_token_counts[-1].prompt
+        return self.token_counter.counts.prompt
 
     @property
     def completion(self):
-        return self.token_counter.llm_token_counts[-1].completion
+        return self.token_counter.counts.completion
@@ -0,0 +1,91 @@
+import os
+import threading
+import time
+import pytest
+
+pytest.importorskip("llama_index")
+
+import index_manager
+from index_manager import IndexManager
+from myutils import (
+    utils_store_index_version,
+    utils_touch_index_lease,
+    utils_served_index_versions,
+    INDEX_VERSIONS_DIR,
+)
+
+
+class FakeStorageContext:
+    def persist(self, persist_dir):
+        os.makedirs(persist_dir)
+
+
+class FakeIndex:
+    storage_context = FakeStorageContext()
+
+
+class FakeQueryEngine:
+    def __init__(self, version, gate=None):
+        self.version = version
+        self.gate = gate
+
+    def query(self, question):
+        if self.gate is not None:
+            self.gate.wait(timeout=5)
+        return self.version
+
+
+@pytest.fixture
+def name(tmp_path, monkeypatch):
+    # The "index" a fake load returns is just the version it was asked for.
+    monkeypatch.setattr(
+        index_manager, "utils_load_index", lambda name, version=None, **kwargs: version
+    )
+    return str(tmp_path / "vector_index")
+
+
+def test_swap_while_query_in_flight(name):
+    v1 = utils_store_index_version(FakeIndex(), name)
+    gate = threading.Event()
+    manager = IndexManager(
+        name,
+        lambda version: FakeQueryEngine(version, gate if version == v1 else None),
+        poll_interval=3600,
+    )
+    manager.start()
+    try:
+        results = []
+        in_flight = threading.Thread(target=lambda: results.append(manager.query("q")))
+        in_flight.start()
+        while manager._slot.in_flight == 0:
+            time.sleep(0.001)
+
+        v2 = utils_store_index_version(FakeIndex(), name)
+        assert manager.check_for_update()
+        assert manager.version == v2
+        # New queries go to the new version while the old one is still answering.
+        assert manager.query("q") == v2
+        (old_slot,) = manager._draining
+        assert old_slot.version == v1 and old_slot.query_engine is not None
+        assert v1 in utils_served_index_versions(name)
+
+        gate.set()
+        in_flight.join()
+        assert results == [v1]
+        # The old engine is dropped, and its lease released, once its last query returns.
+        assert manager._draining == []
+        assert old_slot.query_engine is None
+        assert utils_served_index_versions(name) == {v2}
+    finally:
+        manager.stop()
+
+
+def test_prune_skips_leased_versions(name):
+    v1 = utils_store_index_version(FakeIndex(), name, keep=10)
+    v2 = utils_store_index_version(FakeIndex(), name, keep=10)
+    utils_touch_index_lease(name, v1)
+    v3 = utils_store_index_version(FakeIndex(), name, keep=1)
+
+    versions = sorted(os.listdir(os.path.join(name, INDEX_VERSIONS_DIR)))
+    assert versions == sorted([v1, v3])
+    assert v2 not in versions
@@ -0,0 +1,91 @@
+import pytest
+
+pytest.importorskip("llama_index")
+
+import llm_cache
+from llm_cache import LLMCache, LLMCacheMiss, CachingEmbedding
+
+
+class Clock:
+    def __init__(self):
+        self.now = 1000.0
+
+    def time(self):
+        return self.now
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = Clock()
+    monkeypatch.setattr(llm_cache.time, "time", clock.time)
+    return clock
+
+
+@pytest.fixture
+def path(tmp_path):
+    return str(tmp_path / "llm_cache.db")
+
+
+def test_lru_eviction(path, clock):
+    cache = LLMCache(path, max_entries=2)
+    cache.update("m", "p1", {}, "a1")
+    clock.now += 1
+    cache.update("m", "p2", {}, "a2")
+    clock.now += 1
+    # Using p1 makes p2 the least recently used.
+    assert cache.lookup("m", "p1", {}) == "a1"
+    clock.now += 1
+    cache.update("m", "p3", {}, "a3")
+    assert cache.lookup("m", "p1", {}) == "a1"
+    assert cache.lookup("m", "p2", {}) is None
+    assert cache.lookup("m", "p3", {}) == "a3"
+
+
+def test_ttl_expiry(path, clock):
+    cache = LLMCache(path, ttl=60)
+    cache.update("m", "p", {"temperature": 0}, "a")
+    clock.now += 30
+    assert cache.lookup("m", "p", {"temperature": 0}) == "a"
+    # Different sampling params are a different entry.
+    assert cache.lookup("m", "p", {"temperature": 1}) is None
+    clock.now += 31
+    assert cache.lookup("m", "p", {"temperature": 0}) is None
+
+
+def test_recorded_entries_survive_ttl_and_eviction(path, clock):
+    LLMCache(path, mode="record").update("m", "recorded", {}, "kept")
+    cache = LLMCache(path, max_entries=1, ttl=60)
+    clock.now += 120
+    cache.update("m", "p1", {}, "a1")
+    clock.now += 1
+    cache.update("m", "p2", {}, "a2")
+    assert cache.lookup("m", "recorded", {}) == "kept"
+    assert cache.lookup("m", "p1", {}) is None
+    assert LLMCache(path, mode="replay").lookup("m", "recorded", {}) == "kept"
+
+
+class FakeEmbedding:
+    model = "fake-embedding"
+
+    def __init__(self):
+        self.calls = 0
+
+    def _get_query_embedding(self, query):
+        self.calls += 1
+        return [1.0, 0.0]
+
+
+def test_replay_miss(path):
+    inner = FakeEmbedding()
+    recorder = CachingEmbedding(LLMCache(path, mode="record"), inner)
+    assert recorder._get_query_embedding("recorded") == [1.0, 0.0]
+
+    replay_cache = LLMCache(path, mode="replay")
+    replayer = CachingEmbedding(replay_cache, inner)
+    assert replayer._get_query_embedding("recorded") == [1.0, 0.0]
+    assert inner.calls == 1
+    with pytest.raises(LLMCacheMiss):
+        replayer._get_query_embedding("not recorded")
+    # Replay never writes.
+    replay_cache.update("m", "p", {}, "a")
+    assert replay_cache.lookup("m", "p", {}) is None